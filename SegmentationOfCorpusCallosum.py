@@ -20,12 +20,21 @@ from brainvisa.processes import *
 from brainvisa import registration
 
 import numpy
+import scipy.ndimage
 from soma import aims
 
+try:
+    import cc3d
+except ImportError:
+    cc3d = None
+
 
 name = 'Segmentation of Corpus Callosum'
 userLevel = 0
 
+# Foreground value of the binary volumes written by AimsThreshold -b
+BINARY_FOREGROUND = 32767
+
 # Argument declaration
 signature = Signature(
     't1mri_nobias', ReadDiskItem(
@@ -55,6 +64,7 @@ signature = Signature(
         'Transform Raw T1 MRI to Talairach-AC/PC-Anatomist',
         'Transformation matrix'),
     'do_greywhite_before_cc_mask', Boolean(),
+    'use_cc3d', Boolean(),
     'grey_white', WriteDiskItem(
         'Morphologist Grey White Mask',
         'Aims writable volume formats',
@@ -70,6 +80,89 @@ signature = Signature(
         'Aims writable volume formats'),
 )
 
+
+def _thin_ihp_6c(ihp_arr):
+    """Make the skeletonized inter hemispheric plane 6-connected.
+
+    ihp_arr is the 3D output of VipSkeleton, it is modified in place: each
+    surface voxel (value 60) that has 2 or 3 non-zero 6-neighbours gets its
+    y+1 neighbour set to 120. Voxels are visited in x, y, z order, so that
+    these modifications are seen by the voxels that are visited later.
+
+    The voxel (x, y+1, z) is only ever modified when visiting (x, y, z), so
+    the result of that sequential scan can be computed one y plane at a
+    time: at the time (x, y, z) is visited, all its neighbours already have
+    their final values, except (x+1, y, z) and (x, y+1, z) which still have
+    their original values.
+    """
+    size_x, size_y, size_z = ihp_arr.shape
+    # plane y before the modifications made while visiting plane y-1
+    original_plane = ihp_arr[:, 1].copy()
+    for y in range(1, size_y - 1):
+        plane = ihp_arr[:, y]
+        next_plane = ihp_arr[:, y+1]
+        nv = ((plane[:-2, 1:-1] != 0).astype(numpy.uint8)
+              + (original_plane[2:, 1:-1] != 0)
+              + (ihp_arr[1:-1, y-1, 1:-1] != 0)
+              + (next_plane[1:-1, 1:-1] != 0)
+              + (plane[1:-1, :-2] != 0)
+              + (plane[1:-1, 2:] != 0))
+        hit = (plane[1:-1, 1:-1] == 60) & ((nv == 2) | (nv == 3))
+        original_plane = next_plane.copy()
+        next_plane[1:-1, 1:-1][hit] = 120
+
+
+def _talairach_coordinates(volume, tal):
+    """Return the Talairach coordinates, in millimetres, of all voxels.
+
+    volume is an AIMS volume and tal the transformation from its referential
+    to the Talairach referential. The result is a tuple of three 3D float32
+    arrays (x, y, z), with the same spatial dimensions as volume.
+    """
+    matrix = numpy.asarray(tal.toMatrix(), dtype=numpy.float32)
+    size_x, size_y, size_z = numpy.asarray(volume).shape[:3]
+    vx, vy, vz = list(volume.getVoxelSize())[:3]
+    mm = (numpy.arange(size_x, dtype=numpy.float32)[:, None, None] * vx,
+          numpy.arange(size_y, dtype=numpy.float32)[None, :, None] * vy,
+          numpy.arange(size_z, dtype=numpy.float32)[None, None, :] * vz)
+    return tuple(matrix[row, 0] * mm[0] + matrix[row, 1] * mm[1]
+                 + matrix[row, 2] * mm[2] + matrix[row, 3]
+                 for row in range(3))
+
+
+def _binary_volume(mask, reference):
+    """Create an AIMS volume from a boolean array, like AimsThreshold -b.
+
+    The header (voxel size, referentials...) is copied from the reference
+    AIMS volume.
+    """
+    volume = aims.Volume(numpy.where(mask, BINARY_FOREGROUND, 0)
+                         .astype(numpy.int16))
+    volume.copyHeaderFrom(reference.header())
+    return volume
+
+
+def _dilate(mask, radius, voxel_size):
+    """Dilate a boolean array by a ball of the given radius in millimetres."""
+    if not mask.any():
+        return mask.copy()
+    return scipy.ndimage.distance_transform_edt(
+        ~mask, sampling=voxel_size) <= radius
+
+
+def _erode(mask, radius, voxel_size):
+    """Erode a boolean array by a ball of the given radius in millimetres."""
+    if mask.all():
+        return mask.copy()
+    return scipy.ndimage.distance_transform_edt(
+        mask, sampling=voxel_size) > radius
+
+
+def _close(mask, radius, voxel_size):
+    """Close a boolean array by a ball of the given radius in millimetres."""
+    return _erode(_dilate(mask, radius, voxel_size), radius, voxel_size)
+
+
 # Default values
 def initialization(self):
     def linkCC1(mask):
@@ -105,6 +198,7 @@ def initialization(self):
     self.addLink('corpus_callosum_mask_26c', 'left_grey_white', linkCC2)
 
     self.do_greywhite_before_cc_mask = True
+    self.use_cc3d = cc3d is not None
 
 
 def execution( self, context ):
@@ -122,128 +216,104 @@ def execution( self, context ):
         context.system(*command)
 
     # create inter hemispheric plane
-    ihp = context.temporary('NIFTI-1 image')
-    context.system('AimsThreshold', '-i', self.grey_white, '-o', ihp,
-                   '-t', 0, '-m', 'di', '-b')
-    context.system('AimsMorphoMath', '-i', ihp, '-o', ihp,
-                   '-m', 'clo', '-r', 5)
-    ihp_aims = aims.read(ihp.fullPath())
+    grey_white = aims.read(self.grey_white.fullPath())
+    grey_white_arr = numpy.asarray(grey_white)[:, :, :, 0]
+    voxel_size = list(grey_white.getVoxelSize())[:3]
     tal = aims.read(self.talairach_transformation.fullPath())
+    # all volumes below share the voxel grid of grey_white, so the Talairach
+    # coordinates of their voxels are computed only once
+    tal_x, tal_y, tal_z = _talairach_coordinates(grey_white, tal)
+
+    ihp = context.temporary('NIFTI-1 image')
+    ihp_aims = _binary_volume(_close(grey_white_arr != 0, 5, voxel_size),
+                              grey_white)
     ar = numpy.asarray(ihp_aims)
     #dihp = aims.AimsData(ihp_aims)
-    roiit = aims.getRoiIterator(ihp_aims)
-
-    todel = []
-    while roiit.isValid():
-        mit = roiit.maskIterator()
-        while mit.isValid():
-            q = tal.transform(mit.valueMillimeters())
-            if q[0] < -1.1 or q[0] > 1.1:
-                todel.append(mit.value())
-            mit.next()
-        roiit.next()
-    for v in todel:
-        ar[v[0], v[1], v[2]] = 0
-
-    ihp_6c = context.temporary('NIFTI-1 image')
+    ar[(tal_x < -1.1) | (tal_x > 1.1)] = 0
+
     aims.write(ihp_aims, ihp.fullPath())
 
     # make the ih plane one voxel large / 26 neighbourhood
-    context.system('VipSkeleton', '-i', ihp, '-so', ihp,
+    ihp_sk = context.temporary('NIFTI-1 image')
+    context.system('VipSkeleton', '-i', ihp, '-so', ihp_sk,
                    '-sk', 's', '-im', 'a', '-fv', 'n', '-p', 0)
-    context.system('AimsThreshold', '-i', ihp, '-o', self.interhemispheric_plane,
-                   '-t', 0, '-m', 'di', '-b')
+    ihp_aims = aims.read(ihp_sk.fullPath())
+    ihp_arr = numpy.asarray(ihp_aims)[:, :, :, 0]
+    ihp_26c = ihp_arr != 0
+    aims.write(_binary_volume(ihp_26c, grey_white),
+               self.interhemispheric_plane.fullPath())
 
     # make the ih plane one voxel large / 6 neighbourhood
-    ihp_aims = aims.read(ihp.fullPath())
-    ihp_arr = numpy.asarray(ihp_aims)
-    for x in range(int(ihp_aims.getSizeX())):
-        for y in range(int(ihp_aims.getSizeY())):
-            for z in range(int(ihp_aims.getSizeZ())):
-                if ihp_arr[x, y, z, 0] == 60:
-                    nv = 0
-                    if ihp_arr[x-1, y, z] != 0:
-                        nv += 1
-                    if ihp_arr[x+1, y, z] != 0:
-                        nv += 1
-                    if ihp_arr[x, y-1, z] != 0:
-                        nv += 1
-                    if ihp_arr[x, y+1, z] != 0:
-                        nv += 1
-                    if ihp_arr[x, y, z-1] != 0:
-                        nv += 1
-                    if ihp_arr[x, y, z+1] != 0:
-                        nv += 1
-                    if nv == 2 or nv == 3:
-                        ihp_arr[x, y+1, z] = 120
-    aims.write(ihp_aims, ihp.fullPath())
-    context.system('AimsThreshold', '-i', ihp, '-o', ihp,
-                   '-t', 0, '-m', 'di', '-b')
+    _thin_ihp_6c(ihp_arr)
+    ihp_6c = ihp_arr != 0
 
     # compute white mask
-    white = context.temporary('NIFTI-1 image')
-    context.system('AimsThreshold', '-i', self.grey_white, '-o', white,
-                   '-t', 200, '-m', 'ge')
+    white_arr = numpy.where(grey_white_arr >= 200, grey_white_arr, 0)
     # close white mask
-    context.system('AimsMorphoMath', '-i', white, '-o', white,
-                   '-m', 'ero',  '-r', 1.1)
+    white_arr[~_erode(white_arr != 0, 1.1, voxel_size)] = 0
     #context.system('AimsMorphoMath', '-i', white, '-o', white,
                    #'-m', 'clo',  '-r', 2)
 
     # keep all connected components, then filter them out
-    cc = context.temporary('NIFTI-1 image')
-    context.system('AimsMask', '-i', white, '-m', ihp, '-o', cc)
-    context.system('AimsConnectComp', '-i', cc, '-o', cc,
-                   '-c', 26, '-s', 0)
+    cc_arr = numpy.where(ihp_6c, white_arr, 0)
+    use_cc3d = self.use_cc3d and cc3d is not None
+    if self.use_cc3d and not use_cc3d:
+        context.warning('cc3d is not installed, using AimsConnectComp instead')
+    if use_cc3d:
+        arr = cc3d.connected_components(cc_arr != 0, connectivity=26)
+    else:
+        cc = context.temporary('NIFTI-1 image')
+        cc_aims = aims.Volume(cc_arr)
+        cc_aims.copyHeaderFrom(grey_white.header())
+        aims.write(cc_aims, cc.fullPath())
+        context.system('AimsConnectComp', '-i', cc, '-o', cc,
+                       '-c', 26, '-s', 0)
+        arr = numpy.asarray(aims.read(cc.fullPath()))[..., 0]
 
     minradius = 15
     maxradius = 50
     minradius *= minradius  # square
     maxradius *= maxradius
 
-    vol = aims.read(cc.fullPath())
-    arr = numpy.asarray(vol)
-    roiit = aims.getRoiIterator(vol)
-    todel = []
-    cent = aims.Point3df(0, 10, 0)
-    while roiit.isValid():
-        mit = roiit.maskIterator()
-        p = aims.Point3df(0, 0, 0)
-        n = 0
-        out = 0
-        comp = int(roiit.regionName())
-        while mit.isValid():
-            q = tal.transform(mit.valueMillimeters())
-            p += q
-            r = (q - cent).norm2()
-            if r < minradius or r > maxradius:
-                out += 1
-            n += 1
-            mit.next()
-        p /= n
-        if (p[2] >= -5 or p[2] <= -40 or p[1] <= -40 or p[1] >= 55
-                or out > 0.15 * n):
-            todel.append(comp)
-        roiit.next()
-    for v in todel:
-        arr[arr == v] = 0
-
-    aims.write(vol, cc.fullPath())
+    labels = arr.ravel()
+    r = tal_x ** 2 + (tal_y - 10) ** 2 + tal_z ** 2
+    # per-component voxel count, centroid, and number of voxels out of the
+    # [minradius, maxradius] shell
+    if use_cc3d:
+        stats = cc3d.statistics(arr)
+        n = stats['voxel_counts']
+        comps = numpy.flatnonzero(n)
+        comps = comps[comps != 0]
+        # the Talairach transformation is affine, so the centroid of the
+        # Talairach coordinates is the transformed centroid of the voxels
+        matrix = numpy.asarray(tal.toMatrix())
+        centroids = (stats['centroids'][comps] * voxel_size
+                     @ matrix[:3, :3].T + matrix[:3, 3])
+        p_y = centroids[:, 1]
+        p_z = centroids[:, 2]
+    else:
+        n = numpy.bincount(labels)
+        comps = numpy.flatnonzero(n)
+        comps = comps[comps != 0]
+        p_y = numpy.bincount(labels, weights=tal_y.ravel())[comps] / n[comps]
+        p_z = numpy.bincount(labels, weights=tal_z.ravel())[comps] / n[comps]
+    out = numpy.bincount(labels,
+                         weights=((r < minradius) | (r > maxradius)).ravel(),
+                         minlength=len(n))
+    todel = comps[(p_z >= -5) | (p_z <= -40) | (p_y <= -40) | (p_y >= 55)
+                  | (out[comps] > 0.15 * n[comps])]
+    # remove the rejected components in a single pass with a lookup table
+    lut = numpy.arange(int(arr.max()) + 1, dtype=arr.dtype)
+    lut[todel] = 0
+    arr = lut[arr]
 
     # merge if several components
-    context.system('AimsThreshold', '-i', cc,
-                   '-o', self.corpus_callosum_mask_6c,
-                   '-t', 0, '-m', 'di', '-b')
-    context.system('AimsMorphoMath', '-i', self.corpus_callosum_mask_6c,
-                   '-o', self.corpus_callosum_mask_6c,
-                   '-m', 'dil',  '-r', 1.1)
-    context.system('AimsMorphoMath', '-i', self.corpus_callosum_mask_6c,
-                   '-o', self.corpus_callosum_mask_6c,
-                   '-m', 'clo',  '-r', 2.1)
+    mask_6c = _close(_dilate(arr != 0, 1.1, voxel_size), 2.1, voxel_size)
+    aims.write(_binary_volume(mask_6c, grey_white),
+               self.corpus_callosum_mask_6c.fullPath())
     # mask by ihp in 26 connexity
-    context.system('AimsMask', '-i', self.corpus_callosum_mask_6c,
-                   '-o', self.corpus_callosum_mask_26c,
-                   '-m', self.interhemispheric_plane)
+    aims.write(_binary_volume(mask_6c & ihp_26c, grey_white),
+               self.corpus_callosum_mask_26c.fullPath())
 
     tm = registration.getTransformationManager()
     tm.copyReferential(self.t1mri_nobias, self.grey_white)
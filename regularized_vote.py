@@ -15,8 +15,14 @@ import subprocess
 import sys
 
 import numpy
+import scipy.ndimage
 from soma import aims
 
+try:
+    import nibabel
+except ImportError:
+    nibabel = None
+
 
 CONTRIB_CENTRAL_VOXEL = 0.5
 CONTRIB_NEIGHBOURS = 0.5
@@ -27,53 +33,117 @@ OUTPUT_LABELS = [80, 70, 60, 50, 40, 30, 20]
 EXTENSION = 3
 
 
-def regularize_tdis_at(tdi_array, x, y, z):
-    neighbour_count = 0
-    neighbour_contrib = numpy.zeros((tdi_array.shape[3],),
-                                    dtype=tdi_array.dtype)
-    # On parcourt tous les voisins
-    for i in range(max(x-1, 0), min(x+2, tdi_array.shape[0]+1)):
-        for j in range(max(y-1, 0), min(y+2, tdi_array.shape[0]+1)):
-            for k in range(max(z-1, 0), min(z+2, tdi_array.shape[0]+1)):
-                if tdi_array[i, j, k].max() != 0:  # if there is a vote
-                    if (i, j, k) != (x ,y, z):
-                        neighbour_contrib += tdi_array[i, j, k]
-                        neighbour_count += 1
-    if neighbour_count != 0:
-        return (tdi_array[x, y, z] * CONTRIB_CENTRAL_VOXEL
-                + neighbour_contrib * (CONTRIB_NEIGHBOURS / neighbour_count))
-    else:
-        return tdi_array[x, y, z]
+def neighbour_sum(array):
+    """Sum the 26 neighbours of each voxel of a stack of 3D arrays.
+
+    array is a 4D array, the sums are computed independently for each index
+    of its first axis. Neighbours that fall out of the array count as zeros.
+    """
+    result = numpy.empty_like(array)
+    kernel = numpy.ones((3, 3, 3), dtype=array.dtype)
+    for c in range(array.shape[0]):
+        scipy.ndimage.convolve(array[c], kernel, output=result[c],
+                               mode='constant')
+    result -= array
+    return result
+
+
+def regularize_tdis(tdi_array):
+    """Regularize the track density images over a 3×3×3 neighbourhood.
+
+    tdi_array is a 4D array whose first axis indexes the track density
+    images. Each voxel receives CONTRIB_CENTRAL_VOXEL of its own densities,
+    plus CONTRIB_NEIGHBOURS of the mean densities of its neighbours that have
+    a vote. Voxels without any voting neighbour keep their own densities.
+    """
+    has_vote = (tdi_array.max(axis=0) != 0).astype(tdi_array.dtype)
+    neighbour_count = neighbour_sum(has_vote[None])[0]
+    # Track densities are non-negative, so voxels without a vote are all
+    # zeros and summing over all neighbours is the same as summing over the
+    # voting neighbours only.
+    neighbour_contrib = neighbour_sum(tdi_array)
+    regularized = (
+        tdi_array * CONTRIB_CENTRAL_VOXEL
+        + neighbour_contrib * (CONTRIB_NEIGHBOURS
+                               / numpy.maximum(neighbour_count, 1))
+    )
+    return numpy.where(neighbour_count != 0, regularized, tdi_array)
+
+
+def read_crop(filename, bbox):
+    """Read the part of a 3D volume that lies within a bounding box.
+
+    bbox is a tuple of three slices, in the voxel space of AIMS volumes in
+    memory. When nibabel is available, only the voxels within bbox are read
+    from the file, which is accessed in its storage orientation: bbox is
+    converted using the storage_to_memory matrix from the AIMS header.
+    Otherwise, the whole volume is read with AIMS before cropping.
+    """
+    storage_to_memory = None
+    if nibabel is not None:
+        finder = aims.Finder()
+        if finder.check(filename):
+            storage_to_memory = finder.header().get('storage_to_memory')
+    if storage_to_memory is None:
+        return numpy.asarray(aims.read(filename))[bbox + (0,)]
+
+    storage_to_memory = numpy.reshape(storage_to_memory, (4, 4))
+    storage_slices = [None] * 3
+    storage_axes = []
+    for memory_axis, memory_slice in enumerate(bbox):
+        storage_axis = int(numpy.flatnonzero(
+            storage_to_memory[memory_axis, :3])[0])
+        storage_axes.append(storage_axis)
+        sign = storage_to_memory[memory_axis, storage_axis]
+        offset = int(round(storage_to_memory[memory_axis, 3]))
+        start, stop = memory_slice.start, memory_slice.stop
+        if sign > 0:
+            storage_slices[storage_axis] = slice(start - offset,
+                                                 stop - offset)
+        else:
+            storage_slices[storage_axis] = slice(offset - stop + 1,
+                                                 offset - start + 1)
+    dataobj = nibabel.load(filename).dataobj
+    crop = numpy.asarray(
+        dataobj[tuple(storage_slices) + (0,) * (len(dataobj.shape) - 3)])
+    crop = crop.transpose(storage_axes)
+    for memory_axis, storage_axis in enumerate(storage_axes):
+        if storage_to_memory[memory_axis, storage_axis] < 0:
+            crop = numpy.flip(crop, axis=memory_axis)
+    return crop
 
 
 def regularized_vote(result_dir, subject, tdi_filenames, output_labels):
     # Read the corpus callosum mask, to perform the vote only within the mask
     mask_cc = aims.read(os.path.join(result_dir, subject + '_maskCC_registered2dwi.nii.gz'))
     arr_cc = numpy.asarray(mask_cc)[:, :, :, 0]
-    # Read track density images and stack them in a 4D NumPy array
-    tdi_volumes = [aims.read(tdi_filename) for tdi_filename in tdi_filenames]
-    tdi_array = numpy.concatenate([tdi_vol.np for tdi_vol in tdi_volumes],
-                                  axis=3)
-    tdi_array[arr_cc == 0] = 0
-
-    # Obtain indices of all voxels within the mask
-    tab_x, tab_y, tab_z = arr_cc.nonzero()
+    in_mask = arr_cc != 0
+    # Crop all computations to the bounding box of the mask. Track densities
+    # are zeroed out of the mask, so this does not change the regularization.
+    bbox = scipy.ndimage.find_objects(in_mask.astype(numpy.uint8))[0]
+    in_mask_bbox = in_mask[bbox]
+    # Read track density images one at a time into a 4D NumPy array, indexed
+    # by track density image first. Single precision is enough for the vote,
+    # and halves the memory traffic of the regularization.
+    tdi_array = numpy.empty((len(tdi_filenames),) + in_mask_bbox.shape,
+                            dtype=numpy.float32)
+    for i, tdi_filename in enumerate(tdi_filenames):
+        tdi_array[i] = read_crop(tdi_filename, bbox)
+    tdi_array[:, ~in_mask_bbox] = 0
 
     # Find the smallest type that can contain all labels
     dtype = numpy.uint8
     for label in [0, NO_VOTE] + output_labels:
         dtype = numpy.promote_types(dtype, numpy.min_scalar_type(label))
 
-    result = numpy.zeros_like(arr_cc, dtype=dtype)
     # TODO: choice of datatype based on actual values
-    # Loop on voxels in the mask
-    for x, y, z in zip(tab_x, tab_y, tab_z):
-        regularized_tdis_xyz = regularize_tdis_at(tdi_array, x, y, z)
-        winner_index = numpy.argmax(regularized_tdis_xyz)
-        if regularized_tdis_xyz[winner_index] == 0:
-            result[x, y, z] = NO_VOTE
-        else:
-            result[x, y, z] = output_labels[winner_index]
+    # Vote only on the voxels of the mask
+    regularized_tdis = regularize_tdis(tdi_array)[:, in_mask_bbox]
+    winner_index = regularized_tdis.argmax(axis=0)
+    votes = numpy.take(numpy.array(output_labels, dtype=dtype), winner_index)
+    votes[regularized_tdis.max(axis=0) == 0] = NO_VOTE
+    result = numpy.zeros_like(arr_cc, dtype=dtype)
+    result[bbox][in_mask_bbox] = votes
 
     result_volume = aims.Volume(result)
     result_volume.copyHeaderFrom(mask_cc.header())
@@ -84,10 +154,21 @@ def regularized_vote(result_dir, subject, tdi_filenames, output_labels):
     # To ease visualization, extend the labels 3 slices around the central
     # slice of the midsagittal section of CC.
     extended_result = result.copy()
-    central_x = int(numpy.median(tab_x))
-    extended_result[central_x-EXTENSION:central_x+EXTENSION+1, tab_y, tab_z] = (
-        result[tab_x, tab_y, tab_z]
-    )
+    # Median x coordinate of the voxels of the mask, found from the
+    # cumulative voxel counts of the sagittal slices
+    cumulative_count = numpy.cumsum(in_mask.sum(axis=(1, 2)))
+    voxel_count = int(cumulative_count[-1])
+    median_low, median_high = numpy.searchsorted(
+        cumulative_count, [(voxel_count - 1) // 2, voxel_count // 2],
+        side='right')
+    central_x = int(median_low + median_high) // 2
+    # Project the labels along x: each (y, z) column of the mask takes the
+    # label of its last voxel in the mask, which is then broadcast to all
+    # slices of the extension.
+    last_x = arr_cc.shape[0] - 1 - in_mask[::-1].argmax(axis=0)
+    projected_result = numpy.take_along_axis(result, last_x[None], axis=0)[0]
+    numpy.copyto(extended_result[central_x-EXTENSION:central_x+EXTENSION+1],
+                 projected_result, where=in_mask.any(axis=0))
     extended_result_volume = aims.Volume(extended_result)
     extended_result_volume.copyHeaderFrom(result_volume.header())
     aims.write(extended_result_volume,